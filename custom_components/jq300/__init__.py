@@ -10,15 +10,15 @@ https://github.com/Limych/ha-jq300
 #  (see LICENSE.md or https://creativecommons.org/licenses/by-nc-sa/4.0/)
 
 import asyncio
-import json
 import logging
-from time import monotonic
+import random
+from collections import deque
+from time import monotonic, time
 from typing import Optional, Dict
 
+import aiohttp
 import async_timeout
 import homeassistant.helpers.config_validation as cv
-import homeassistant.util.dt as dt_util
-import requests
 import voluptuous as vol
 from homeassistant import exceptions
 from homeassistant.const import (
@@ -29,11 +29,11 @@ from homeassistant.const import (
     CONCENTRATION_MILLIGRAMS_PER_CUBIC_METER,
     CONCENTRATION_PARTS_PER_MILLION,
     CONF_SCAN_INTERVAL,
+    EVENT_HOMEASSISTANT_STOP,
 )
 from homeassistant.helpers import discovery
-from homeassistant.helpers.dispatcher import dispatcher_send
+from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.event import async_track_time_interval
-from requests import PreparedRequest
 
 from .const import (
     DOMAIN,
@@ -64,10 +64,32 @@ from .const import (
     SIGNAL_UPDATE_JQ300,
     CONF_ACCOUNT_ID,
 )
-from .util import mask_email
+from .util import TokenBucket, mask_email
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # pragma: no cover
+    from json import loads as json_loads
 
 _LOGGER = logging.getLogger(__name__)
 
+# Precomputed interval lengths for hot paths, in seconds.
+# NB: POSIX timestamps are timezone-agnostic, so time.time() is
+# interchangeable with dt_util.now().timestamp() here.
+_UPDATE_MIN_INTERVAL_S = int(UPDATE_MIN_INTERVAL.total_seconds())
+_SENSORS_FILTER_FRAME_S = int(SENSORS_FILTER_FRAME.total_seconds())
+
+# Ring buffer capacity for per-device history: at most one sample per
+# UPDATE_MIN_INTERVAL fits into the filter frame, plus a small margin.
+_SENSORS_BUFFER_LEN = _SENSORS_FILTER_FRAME_S // _UPDATE_MIN_INTERVAL_S + 5
+
+# Merged metadata for all supported sensor ids; the flag marks analog
+# sensors from SENSORS as opposed to binary ones.
+_ALL_SENSOR_META = {
+    **{sensor_id: (data, False) for sensor_id, data in BINARY_SENSORS.items()},
+    **{sensor_id: (data, True) for sensor_id, data in SENSORS.items()},
+}
+
 ACCOUNT_SCHEMA = vol.Schema(
     {
         vol.Required(CONF_USERNAME): cv.string,
@@ -109,9 +131,12 @@ async def async_setup(hass, config):
         hass, username, password, receive_tvoc_in_ppb, receive_hcho_in_ppb
     )
 
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, account.async_close)
+
     try:
         devices = await account.async_update_devices_or_timeout()
     except CannotConnect:
+        await account.async_close()
         return False
 
     devs = {}
@@ -127,6 +152,7 @@ async def async_setup(hass, config):
     try:
         await account.async_update_sensors_or_timeout()
     except CannotConnect:
+        await account.async_close()
         return False
 
     async_track_time_interval(hass, account.update_sensors, scan_interval)
@@ -169,6 +195,7 @@ class JqAccount:
             "uid": -1000,
             "safeToken": "anonymous",
         }
+        self._sync_params()
 
         self.hass = hass
         self._username = username
@@ -178,23 +205,46 @@ class JqAccount:
 
         self._active_devices = []
         self._available = False
-        self._session = requests.session()
+        self._fetch_semaphore = asyncio.Semaphore(4)
+        self._connect_lock = asyncio.Lock()
+        self._api_limiter = TokenBucket(max_rate=8, time_period=2)
+        self._device_limiter = TokenBucket(max_rate=10, time_period=2)
+        # NB: The session is created once and reused for the whole account
+        # lifetime (connect() only refreshes tokens), so TCP connections and
+        # TLS sessions persist between polls to the same host.
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=QUERY_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit_per_host=4, keepalive_timeout=75),
+            headers={"Connection": "keep-alive"},
+        )
         self._devices = {}
         self._sensors = {}
         self._sensors_raw = {}
+        self._last_ts = {}
         self._units = {}
         self._sensors_last_update = 0
 
-        for sensor_id, data in BINARY_SENSORS.items():
-            self._units[sensor_id] = data[1]
-        for sensor_id, data in SENSORS.items():
-            if (receive_tvoc_in_ppb and sensor_id == 8) or (
-                receive_hcho_in_ppb and sensor_id == 7
+        for sensor_id, (data, is_analog) in _ALL_SENSOR_META.items():
+            if is_analog and (
+                (receive_tvoc_in_ppb and sensor_id == 8)
+                or (receive_hcho_in_ppb and sensor_id == 7)
             ):
                 self._units[sensor_id] = CONCENTRATION_PARTS_PER_BILLION
             else:
                 self._units[sensor_id] = data[1]
 
+        # Precomputed per-sensor state conversions for _fetch_sensors
+        self._scale = {sensor_id: 1.0 for sensor_id in self._units}
+        if receive_tvoc_in_ppb:
+            self._scale[8] = 1000 * 24.45 / MWEIGTH_TVOC
+        if receive_hcho_in_ppb:
+            self._scale[7] = 1000 * 24.45 / MWEIGTH_HCHO
+        self._as_int = {
+            sensor_id
+            for sensor_id, unit in self._units.items()
+            if unit != CONCENTRATION_MILLIGRAMS_PER_CUBIC_METER
+        }
+
     @property
     def unique_id(self) -> str:
         """Return a controller unique ID."""
@@ -220,6 +270,17 @@ class JqAccount:
         """Get list of units for sensors."""
         return self._units
 
+    async def async_close(self, _=None):
+        """Close connection to cloud."""
+        await self._session.close()
+
+    def _sync_params(self):
+        """Rebuild prebuilt per-query-type request params after token changes."""
+        uid = str(self.params["uid"])
+        token = str(self.params["safeToken"])
+        self._api_params = {"uid": uid, "safeToken": token}
+        self._device_params = {"uid": uid, "saveToken": token}
+
     @staticmethod
     def _get_useragent(query_type) -> str:
         """Generate User-Agent for requests."""
@@ -231,72 +292,61 @@ class JqAccount:
         else:
             raise ValueError('Unknown query type "%s"' % query_type)
 
-    def _add_url_params(self, url: str, extra_params: dict):
-        """Add params to URL."""
-        params = self.params.copy()
-        params.update(extra_params)
-
-        req = PreparedRequest()
-        req.prepare_url(url, params)
-
-        return req.url
-
-    def _get_url(self, query_type, function: str, extra_params=None) -> str:
-        """Generate request URL."""
+    # pylint: disable=R0911,R0912
+    async def _query(
+        self, query_type, function: str, extra_params=None
+    ) -> Optional[dict]:
+        """Query data from cloud."""
         if query_type == QUERY_TYPE_API:
             url = BASE_URL_API + function
         elif query_type == QUERY_TYPE_DEVICE:
             url = BASE_URL_DEVICE + function
         else:
             raise ValueError('Unknown query type "%s"' % query_type)
-
-        if extra_params:
-            url = self._add_url_params(url, extra_params)
-        return url
-
-    # pylint: disable=R0911,R0912
-    def _query(self, query_type, function: str, extra_params=None) -> Optional[dict]:
-        """Query data from cloud."""
-        url = self._get_url(query_type, function)
         _LOGGER.debug("Querying %s", url)
 
-        response = None
+        content = None
 
-        # allow to override params when necessary
-        # and update self.params globally for the next connection
-        params = self.params.copy()
-        if query_type == QUERY_TYPE_DEVICE:
-            params["saveToken"] = params["safeToken"]
-            del params["safeToken"]
+        # allow to override params when necessary;
+        # the prebuilt base dicts are kept in sync with self.params
+        base_params = (
+            self._api_params if query_type == QUERY_TYPE_API else self._device_params
+        )
         if extra_params:
-            params.update(extra_params)
+            params = {
+                **base_params,
+                **{key: str(val) for key, val in extra_params.items()},
+            }
+        else:
+            params = base_params
+
+        limiter = (
+            self._api_limiter if query_type == QUERY_TYPE_API else self._device_limiter
+        )
 
         try:
-            ret = self._session.get(
+            async with limiter, self._session.get(
                 url,
                 params=params,
                 headers={"User-Agent": self._get_useragent(query_type)},
-                timeout=QUERY_TIMEOUT,
-            )
-            _LOGGER.debug("_query ret %s", ret.status_code)
+            ) as ret:
+                _LOGGER.debug("_query ret %s", ret.status)
+                if ret.status == 200 or ret.status == 204:
+                    content = await ret.read()
 
         # pylint: disable=broad-except
         except Exception as err_msg:
             _LOGGER.error("Error! %s", err_msg)
             return None
 
-        if ret.status_code == 200 or ret.status_code == 204:
-            response = ret
-
-        if response is None:  # pragma: no cover
+        if content is None:  # pragma: no cover
             _LOGGER.debug(MSG_GENERIC_FAIL)
             return None
 
-        _LOGGER.debug(response.content)
-        if response.content.startswith(b"jsoncallback("):
-            response = json.loads(response.content[13:-1])
-        else:
-            response = json.loads(response.content)
+        _LOGGER.debug(content)
+        if content.startswith(b"jsoncallback("):
+            content = content.removeprefix(b"jsoncallback(").removesuffix(b")")
+        response = json_loads(content)
 
         if query_type == QUERY_TYPE_API:
             if response["code"] == 102:
@@ -312,41 +362,68 @@ class JqAccount:
             if int(response["returnCode"]) != 0:
                 _LOGGER.error(MSG_GENERIC_FAIL)
                 self.params["uid"] = -1000
+                self._sync_params()
                 return None
         else:
             raise ValueError('Unknown query type "%s"' % query_type)
 
         return response
 
+    async def _query_with_retries(
+        self, query_type, function: str, extra_params=None, attempts=3
+    ) -> Optional[dict]:
+        """Query data from cloud, retrying with exponential backoff and jitter."""
+        ret = None
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(min(60, 2 ** attempt + random.random()))
+                if query_type == QUERY_TYPE_DEVICE and not self.is_connected:
+                    # The failed attempt invalidated our token; retrying
+                    # with the sentinel credentials cannot succeed.
+                    if not await self.connect():
+                        break
+            ret = await self._query(query_type, function, extra_params)
+            if ret:
+                break
+        return ret
+
     @property
     def is_connected(self):
         """Return True if connected to account."""
         return self.params["uid"] > 0
 
-    def connect(self, force=False) -> bool:
+    async def connect(self, force=False) -> bool:
         """(Re)Connect to account and return connection status."""
         if not force and self.params["uid"] > 0:
             return True
 
-        self.params["uid"] = -1000
-        self.params["safeToken"] = "anonymous"
-        ret = self._query(
-            QUERY_TYPE_API,
-            "loginByEmail",
-            extra_params={
-                "chr": "clt",
-                "email": self._username,
-                "password": self._password,
-                "os": 2,
-            },
-        )
-        if not ret:
-            return self.connect(True) if not force else False
+        async with self._connect_lock:
+            # Concurrent fetches coalesce into one login: a caller that
+            # waited here rides on the token the winner just obtained.
+            if not force and self.params["uid"] > 0:
+                return True
+
+            self.params["uid"] = -1000
+            self.params["safeToken"] = "anonymous"
+            self._sync_params()
+            ret = await self._query_with_retries(
+                QUERY_TYPE_API,
+                "loginByEmail",
+                extra_params={
+                    "chr": "clt",
+                    "email": self._username,
+                    "password": self._password,
+                    "os": 2,
+                },
+            )
+            if not ret:
+                return False
 
-        self.params["uid"] = ret["uid"]
-        self.params["safeToken"] = ret["safeToken"]
-        self._devices = {}
-        return True
+            self.params["uid"] = ret["uid"]
+            self.params["safeToken"] = ret["safeToken"]
+            self._sync_params()
+            self._devices = {}
+            return True
 
     @property
     def active_devices(self) -> list:
@@ -359,11 +436,11 @@ class JqAccount:
         self._active_devices = devices
 
         for device_id in devices:
-            self._sensors.setdefault(device_id, {})
+            self._sensors.setdefault(device_id, deque(maxlen=_SENSORS_BUFFER_LEN))
 
-    def update_devices(self, force=False) -> Optional[dict]:
+    async def update_devices(self, force=False) -> Optional[dict]:
         """Update available devices."""
-        if not self.connect():
+        if not await self.connect():
             _LOGGER.error("Can't connect to cloud.")
             return None
 
@@ -372,7 +449,7 @@ class JqAccount:
 
         _LOGGER.debug("Updating devices list for account %s", self.name_secure)
 
-        ret = self._query(
+        ret = await self._query_with_retries(
             QUERY_TYPE_API,
             "deviceManager",
             extra_params={
@@ -382,29 +459,25 @@ class JqAccount:
             },
         )
         if not ret:
-            return self.update_devices(True) if not force else None
+            return None
 
-        tstamp = int(dt_util.now().timestamp() * 1000)
+        tstamp = int(time() * 1000)
         for dev in ret["deviceInfoBodyList"]:
             dev[""] = tstamp
             self._devices[dev["deviceid"]] = dev
 
         for device_id in self._devices:
-            self._sensors.setdefault(device_id, {})
+            self._sensors.setdefault(device_id, deque(maxlen=_SENSORS_BUFFER_LEN))
 
         return self._devices
 
     async def async_update_devices_or_timeout(self, timeout=UPDATE_TIMEOUT):
         """Get available devices list from cloud."""
+        start = monotonic()
+        devices = None
         try:
             with async_timeout.timeout(timeout):
-                start = monotonic()
-                await self.hass.async_add_job(self.update_devices)
-                while not self._devices:
-                    # Waiting for connection and check datas ready
-                    await asyncio.sleep(1)
-
-                return self._devices
+                devices = await self.update_devices()
 
         except asyncio.TimeoutError:
             _LOGGER.error("Timeout fetching %s devices list", self.name_secure)
@@ -422,19 +495,23 @@ class JqAccount:
                 monotonic() - start,
             )
 
+        if not devices:
+            raise CannotConnect
+        return devices
+
     @property
     def devices(self) -> dict:
         """Get available devices."""
         return self._devices
 
-    def _fetch_sensors(self, device_id, ts_now, force=False) -> bool:
+    async def _fetch_sensors(self, device_id, ts_now) -> bool:
         """Fetch states of available sensors for device."""
-        devices = self.update_devices()
+        devices = await self.update_devices()
         if not devices or not devices[device_id]:
             _LOGGER.error("Can't receive devices list from cloud.")
             return False
 
-        ret = self._query(
+        ret = await self._query_with_retries(
             QUERY_TYPE_DEVICE,
             "list",
             extra_params={
@@ -445,55 +522,56 @@ class JqAccount:
             },
         )
         if not ret:
-            return self._fetch_sensors(device_id, ts_now, True) if not force else False
-
-        res = {}
-        for sensor in ret["deviceValueVos"]:
-            sensor_id = sensor["seq"]
-            if sensor["content"] is None or (
-                sensor_id not in SENSORS.keys()
-                and sensor_id not in BINARY_SENSORS.keys()
-            ):
-                continue
+            return False
 
-            res[sensor_id] = float(sensor["content"])
-            if sensor_id == 8 and self._receive_tvoc_in_ppb:
-                res[sensor_id] *= 1000 * 24.45 / MWEIGTH_TVOC
-            elif sensor_id == 7 and self._receive_hcho_in_ppb:
-                res[sensor_id] *= 1000 * 24.45 / MWEIGTH_HCHO
-            if self._units[sensor_id] != CONCENTRATION_MILLIGRAMS_PER_CUBIC_METER:
-                res[sensor_id] = int(res[sensor_id])
+        # NB: the cloud is not consistent in "content" types: values decoded
+        # from JSON numbers are floats already, the rest are numeric strings.
+        res = {
+            sensor["seq"]: (content if isinstance(content, float) else float(content))
+            * self._scale[sensor["seq"]]
+            for sensor in ret["deviceValueVos"]
+            if (content := sensor["content"]) is not None
+            and sensor["seq"] in _ALL_SENSOR_META
+        }
+        for sensor_id in self._as_int & res.keys():
+            res[sensor_id] = int(res[sensor_id])
 
-        self._sensors[device_id][ts_now] = res
+        self._sensors[device_id].append((ts_now, res))
         self._sensors_raw[device_id] = res
+        self._last_ts[device_id] = ts_now
         self._sensors_last_update = monotonic()
         return True
 
-    def update_sensors(self, _=None):
+    async def _fetch_sensors_limited(self, device_id, ts_now) -> bool:
+        """Fetch states of available sensors respecting connection pool limits."""
+        async with self._fetch_semaphore:
+            return await self._fetch_sensors(device_id, ts_now)
+
+    async def update_sensors(self, _=None):
         """Update current states of all active devices for account."""
         _LOGGER.debug("Updating sensors state for account %s", self.name_secure)
 
-        ts_now = int(dt_util.now().timestamp())
+        ts_now = int(time())
 
-        for device_id in self.active_devices:
-            if (
-                not self._sensors[device_id]
-                or max(self._sensors[device_id])
-                < ts_now - UPDATE_MIN_INTERVAL.total_seconds()
-            ):
-                self._fetch_sensors(device_id, ts_now)
+        tasks = [
+            self._fetch_sensors_limited(device_id, ts_now)
+            for device_id in self.active_devices
+            if self._last_ts.get(device_id, 0) < ts_now - _UPDATE_MIN_INTERVAL_S
+        ]
+        if not tasks:
+            return
 
-        dispatcher_send(self.hass, SIGNAL_UPDATE_JQ300)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Don't wake up all subscribed entities when nothing new arrived
+        if any(res is True for res in results):
+            async_dispatcher_send(self.hass, SIGNAL_UPDATE_JQ300)
 
     async def async_update_sensors_or_timeout(self, timeout=UPDATE_TIMEOUT):
         """Update current states of all active devices for account."""
+        start = monotonic()
         try:
             with async_timeout.timeout(timeout):
-                start = monotonic()
-                await self.hass.async_add_job(self.update_sensors)
-                while self._sensors_last_update < start:
-                    # Waiting for connection and check datas ready
-                    await asyncio.sleep(1)
+                await self.update_sensors()
 
         except asyncio.TimeoutError:
             _LOGGER.error("Timeout fetching %s device's sensors", self.name_secure)
@@ -513,69 +591,55 @@ class JqAccount:
                 monotonic() - start,
             )
 
+        if self._sensors_last_update < start:
+            raise CannotConnect
+
     def get_sensors_raw(self, device_id) -> Optional[dict]:
         """Get raw values of states of available sensors for device."""
         return self._sensors_raw.get(device_id)
 
     def get_sensors(self, device_id) -> Optional[dict]:
         """Get states of available sensors for device."""
-        ts_now = int(dt_util.now().timestamp())
-        ts_overdue = ts_now - SENSORS_FILTER_FRAME.total_seconds()
-
-        self._sensors.setdefault(device_id, {})
+        ts_now = int(time())
+        ts_overdue = ts_now - _SENSORS_FILTER_FRAME_S
 
-        # Filter historic states
-        res = {}
-        ts_min = max(
-            list(filter(lambda x: x <= ts_overdue, self._sensors[device_id].keys()))
-            or {ts_overdue}
+        sensors = self._sensors.setdefault(
+            device_id, deque(maxlen=_SENSORS_BUFFER_LEN)
         )
-        # _LOGGER.debug('ts_overdue: %s; ts_min: %s', ts_overdue, ts_min)
-        for m_ts, val in self._sensors[device_id].items():
-            if m_ts >= ts_min:
-                res[m_ts] = val
-        self._sensors[device_id] = res
 
-        if not self._sensors[device_id]:
+        # Filter historic states: keep the last overdue state (if any)
+        # as a baseline and drop everything older.
+        while len(sensors) > 1 and sensors[1][0] <= ts_overdue:
+            sensors.popleft()
+
+        if not sensors:
             return None
 
-        # Calculate average state values
-        res = {}
-        last_ts = ts_overdue
-        last_data: Dict[int, float] = {}
-        for sensor_id in self._sensors_raw[device_id]:
-            res.setdefault(sensor_id, 0)
-            last_data.setdefault(sensor_id, 0)
-        # Sum values
-        for m_ts, data in self._sensors[device_id].items():
-            val_t = m_ts - last_ts
+        # Calculate time-weighted average state values: compute all sample
+        # timespans up front, then accumulate each sample exactly once.
+        # NB: History frames stay small (dozens of samples), so plain
+        # accumulation beats pulling in a vector math dependency.
+        timestamps = [max(m_ts, ts_overdue) for m_ts, _ in sensors]
+        timestamps.append(ts_now + 1)
+        sums: Dict[int, float] = dict.fromkeys(self._sensors_raw[device_id], 0)
+        for (_, data), ts_cur, ts_next in zip(sensors, timestamps, timestamps[1:]):
+            val_t = ts_next - ts_cur
             if val_t > 0:
-                # _LOGGER.debug('%s: %s [%s]', m_ts, data, (m_ts - last_ts))
-                for sensor_id, val in last_data.items():
-                    res[sensor_id] += val * val_t
-            last_ts = max(m_ts, ts_overdue)
-            last_data = data
-        # Add last values
-        # _LOGGER.debug('%s: %s [%s]', last_ts, last_data,
-        #               max(ts_now - last_ts, 1))
-        val_t = ts_now - last_ts + 1
-        for sensor_id, val in last_data.items():
-            res[sensor_id] += val * val_t
+                # _LOGGER.debug('%s: %s [%s]', ts_cur, data, val_t)
+                for sensor_id, val in data.items():
+                    sums[sensor_id] += val * val_t
         # Average and round
-        length = max(
-            1, ts_now - max(min(self._sensors[device_id].keys()), ts_overdue) + 1
-        )
-        # _LOGGER.debug('Averaging: %s / %s', res, length)
-        for sensor_id in res:
+        length = max(1, ts_now - timestamps[0] + 1)
+        # _LOGGER.debug('Averaging: %s / %s', sums, length)
+        res = {}
+        for sensor_id, val_sum in sums.items():
             res[sensor_id] = (
                 self._sensors_raw[device_id][1]
                 if sensor_id == 1
-                else int(res[sensor_id] / length)
+                else int(val_sum / length)
                 if self._units[sensor_id]
                 in (CONCENTRATION_PARTS_PER_MILLION, CONCENTRATION_PARTS_PER_BILLION,)
-                else round(
-                    res[sensor_id] / length, 1 if isinstance(res[sensor_id], int) else 3
-                )
+                else round(val_sum / length, 1 if isinstance(val_sum, int) else 3)
             )
         # _LOGGER.debug('Result: %s', res)
         return res
@@ -77,8 +77,8 @@ class JqBinarySensor(BinarySensorDevice):
 
         self.entity_id = entity_id
 
-        device = account.update_devices()
-        if device is None:
+        device = account.devices
+        if not device:
             raise exceptions.PlatformNotReady
 
         self._account = account
@@ -154,7 +154,7 @@ class JqBinarySensor(BinarySensorDevice):
         """Return the polling state."""
         return False
 
-    def update(self):
+    async def async_update(self):
         """Update the sensor state if it needed."""
         ret = self._account.get_sensors_raw(self._device_id)
         if ret:
@@ -80,8 +80,8 @@ class JqSensor(Entity):
 
         self.entity_id = entity_id
 
-        device = account.update_devices()
-        if device is None:
+        device = account.devices
+        if not device:
             raise exceptions.PlatformNotReady
 
         self._account = account
@@ -163,7 +163,7 @@ class JqSensor(Entity):
         """Return the polling state."""
         return False
 
-    def update(self):
+    async def async_update(self):
         """Update the sensor state if it needed."""
         ret = self._account.get_sensors(self._device_id)
         if ret:
@@ -9,11 +9,51 @@ https://github.com/Limych/ha-jq300
 #  Creative Commons BY-NC-SA 4.0 International Public License
 #  (see LICENSE.md or https://creativecommons.org/licenses/by-nc-sa/4.0/)
 
+import asyncio
 import logging
+from time import monotonic
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class TokenBucket:
+    """Async token bucket rate limiter.
+
+    Allows up to max_rate requests per time_period seconds, smoothing
+    bursts into a steady rate instead of rejecting them.
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 1.0):
+        """Initialize rate limiter."""
+        self._rate = max_rate / time_period
+        self._capacity = max_rate
+        self._tokens = max_rate
+        self._checked = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request token is available and consume it."""
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._checked) * self._rate,
+                )
+                self._checked = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    async def __aenter__(self):
+        """Acquire a token on context enter."""
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Nothing to release on context exit."""
+
+
 def mask(text: str, first: int = 2, last: int = 1):
     """Mask text by asterisks."""
     tlen = len(text)